@@ -1,5 +1,109 @@
+import math
+import os
+import tempfile
+
 from pyo import *
 
+try:
+    from numba import njit
+except ImportError:
+    # Without numba the ladder kernel of render_offline() runs as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# Size of the wavetables read by the oscillators
+_TABLE_SIZE = 2048
+# Number of harmonics of a wavetable when sharp is 1
+_MAX_ORDER = 32
+# Wavetables per oscillator, one per octave of pitch, each with at most half the harmonics of the previous one
+_NUM_BANDS = _MAX_ORDER.bit_length()
+# Waveform types that can be read from a wavetable instead of computed by LFO
+_TABLE_TYPES = (0, 1, 2, 3)
+
+
+def _harmonics(wavetype, sharp, maxOrder=_MAX_ORDER):
+    """Harmonic amplitudes of a saw up, saw down, square or triangle wave, more of them as sharp grows."""
+    # Same sharpness range as LFO
+    sharp = min(max(sharp, 0.0), 1.0)
+    order = min(1 + int(round(sharp * (_MAX_ORDER - 1))), maxOrder)
+    if wavetype == 0:
+        return [-1.0 / k for k in range(1, order + 1)]
+    elif wavetype == 1:
+        return [1.0 / k for k in range(1, order + 1)]
+    elif wavetype == 2:
+        return [1.0 / k if k % 2 else 0.0 for k in range(1, order + 1)]
+    else:
+        return [(-1) ** (k // 2) / k ** 2 if k % 2 else 0.0 for k in range(1, order + 1)]
+
+
+def _band(freq, base):
+    """Wavetable band for a note of `freq` Hz, band b holding notes up to base * 2**b Hz."""
+    if freq <= base:
+        return 0
+    return min(int(math.ceil(math.log2(freq / base))), _NUM_BANDS - 1)
+
+
+# MIDI input shared by every mySubSynth, created by the first one on the current server
+_notein = None
+
+
+def _shared_notein():
+    """Note pitches in Hz, velocities and note-on triggers, created once per server boot and shared by all synths."""
+    global _notein
+    if _notein is None or not _is_alive(_notein[0]):
+        notes = Notein()
+        # Show a keyboard widget to supply MIDI events
+        notes.keyboard()
+        # Note pitches
+        freqs = MToF(notes["pitch"])
+        _notein = (notes, freqs, notes["velocity"], notes["trigon"])
+    return _notein[1:]
+
+
+def _is_alive(obj):
+    """Whether `obj` still runs on a booted server, shutting a server down erases all its objects."""
+    server = obj.getServer()
+    return bool(server.getIsBooted()) and obj.getBaseObjects()[0]._getStream() in server.getStreams()
+
+
+@njit(cache=True, fastmath=True)
+def moog_ladder(x, state, f, r, sr, out):
+    """
+    Four-pole nonlinear Moog ladder lowpass filter, computed the same way as pyo's MoogLP.
+
+    Filters `x` into `out` with the per-sample cutoff frequencies `f` (in Hz) and the
+    resonance `r`, carrying the four stage outputs and their previous inputs in the
+    eight values of `state` from one call to the next.
+    """
+    r = min(max(r, 0.0), 10.0)
+    lastFreq = -1.0
+    p = k = fb = 0.0
+    for i in range(x.shape[0]):
+        freq = min(max(f[i], 0.1), sr * 0.49)
+        if freq != lastFreq:
+            lastFreq = freq
+            fn = 2.0 * freq / sr
+            p = fn * (1.8 - 0.8 * fn)
+            k = 2.0 * math.sin(fn * math.pi * 0.5) - 1.0
+            t = (1.0 - p) * 1.386249
+            t2 = 12.0 + t * t
+            fb = r * 0.5 * (t2 + 6.0 * t) / (t2 - 6.0 * t)
+            # Resonance compensation according to the normalized frequency
+            fb *= (1.0 - fn) ** 3 * 0.9 + 0.1
+        u = x[i] - fb * state[3]
+        state[0] = (u + state[4]) * p - k * state[0]
+        state[1] = (state[0] + state[5]) * p - k * state[1]
+        state[2] = (state[1] + state[6]) * p - k * state[2]
+        state[3] = (state[2] + state[7]) * p - k * state[3]
+        # Soft clipping of the last stage
+        state[3] -= state[3] * state[3] * state[3] / 6.0
+        state[4] = u
+        state[5] = state[0]
+        state[6] = state[1]
+        state[7] = state[2]
+        out[i] = state[3]
+
+
 class mySubSynth(PyoObject):
 
     """
@@ -59,11 +163,22 @@ class mySubSynth(PyoObject):
         Amount of Resonance of the filter, usually between 0 (no resonance)  
         and 1 (medium resonance). Default to 0.5
 
+    When the waveform is a saw, a square or a triangle and the sharpness is a float,
+    the oscillator reads a precomputed wavetable whose number of harmonics is given
+    by the sharpness, and halved for each octave of pitch where they would go past
+    the Nyquist frequency. The other waveforms, or a PyoObject sharpness, use an LFO.
+
     >>> s=Server().boot()
     >>> sy = mySubSynth().out()
     >>> sy.ctrl()
     """
 
+    # PyoObject still provides a __dict__, but the synth's own attributes live in slots
+    __slots__ = ('_type1', '_sharp1', '_type2', '_sharp2', '_type3', '_sharp3', '_cutoffFact', '_res',
+                 '_env', '_freqs', '_bandBase', '_tables', '_waves', '_lfos', '_oscs', '_sources', '_noteTrig',
+                 '_sum', '_scaled', '_cutoffSig', '_cutoffFreq', '_filt', '_mono', '_stereo', '_children',
+                 '_base_objs', '_map_list_osc', '_map_list_filt')
+
     def __init__(self, type1=0, sharp1=1, type2=0, sharp2=1, type3=0, sharp3=1, cutoffFact=0.5, res=0.5):
         
         # Call superclass (PyoObject) constructor
@@ -79,41 +194,62 @@ class mySubSynth(PyoObject):
         self._cutoffFact = cutoffFact
         self._res = res
 
-        # pitches in Hz
-        notes = Notein()
-        # Show a keyboard widget to supply MIDI events
-        notes.keyboard()
-       
-        # Note pitches
-        freqs = MToF(notes["pitch"])
-        # ADSR on note amplitudes
-        self._env = MidiAdsr(notes["velocity"], attack=0.05, decay=0.4, sustain=0.2, release=0.5, mul=0.65)
+        # MIDI notes and pitches in Hz, shared with the other synths
+        freqs, vel, trigon = _shared_notein()
+        # ADSR on note amplitudes, specific to this synth
+        self._env = MidiAdsr(vel, attack=0.05, decay=0.4, sustain=0.2, release=0.5, mul=0.65)
 
         # Define audio processing chain using constructor arguments
-        #1. Create the first oscillator
-        self._osc1 = LFO(freq=freqs, sharp=self._sharp1, type=self._type1, mul=self._env)
-        #2. Add the first oscillator to the second one
-        self._osc2 = LFO(freq=freqs, sharp=self._sharp2, type=self._type2, mul=self._env, add=self._osc1)
-        #3. Add the sum the previuos two oscillators to the third one
-        self._osc3 = LFO(freq=freqs, sharp=self._sharp3, type=self._type3, mul=self._env, add=self._osc2)
+        #1. Create the three oscillators, each one either reading its wavetable or computed by its LFO
+        self._freqs = freqs
+        # Highest pitch for which a wavetable can hold _MAX_ORDER harmonics below the Nyquist frequency
+        self._bandBase = freqs.getSamplingRate() / 2 / _MAX_ORDER
+        self._tables = tuple(tuple(HarmTable(size=_TABLE_SIZE) for b in range(_NUM_BANDS)) for i in range(3))
+        self._waves = tuple(Osc(table=t[0], freq=freqs) for t in self._tables)
+        self._lfos = (LFO(freq=freqs, sharp=self._sharp1, type=self._type1),
+                      LFO(freq=freqs, sharp=self._sharp2, type=self._type2),
+                      LFO(freq=freqs, sharp=self._sharp3, type=self._type3))
+        # Only the active oscillators are kept playing, so the server must not restart the idle ones
+        for o in self._waves + self._lfos:
+            o.allowAutoStart(False)
+        self._oscs = list(self._lfos)
+        # One switchable source per oscillator, reading either its Osc or its LFO
+        self._sources = tuple(InputFader(o) for o in self._lfos)
+        self._routeOsc(0, self._type1, self._sharp1)
+        self._routeOsc(1, self._type2, self._sharp2)
+        self._routeOsc(2, self._type3, self._sharp3)
+        # Each new note picks the wavetables matching its pitch
+        self._noteTrig = TrigFunc(trigon, self._selectBand, arg=list(range(len(freqs))))
+        #2. Sum the three oscillators, keeping one stream per note
+        self._sum = Mix(list(self._sources), voices=len(freqs))
+        #3. Apply the envelope once, on the sum of the oscillators
+        self._scaled = self._sum * self._env
 
         #4. Filter the result of the sum of the three oscillators with a lowpass resonant filter
-        self._filt = MoogLP(input=self._osc3, freq=self._env*20000*self._cutoffFact, res=self._res)
-        #5. Make the signal stereo
-        self._stereo = Pan(self._filt, outs=2, pan=0.5)
+        # The cutoff factor lives in a persistent Sig, so changing it only updates its value
+        self._cutoffSig = Sig(value=self._cutoffFact)
+        self._cutoffFreq = self._env*20000*self._cutoffSig
+        self._filt = MoogLP(input=self._scaled, freq=self._cutoffFreq, res=self._res)
+        #5. Make the signal stereo, summing the notes to mono and duplicating it on both channels
+        # with the -3 dB gain of a centered equal-power pan
+        self._mono = Mix(self._filt, voices=1)
+        self._stereo = Mix(self._mono, voices=2, mul=0.707)
 
 
+        # Processing chain started and stopped along with the synth
+        self._children = self._sources + (self._sum, self._scaled, self._filt, self._mono, self._stereo)
+
         # Define output seen by outside world: self._base_objs
         # Returned by getBaseObjects() method
         self._base_objs = self._stereo.getBaseObjects()
 
     def ctrl(self, map_list=None, title=None, wxnoserver=False):
         self._map_list_osc = [SLMap(0, 7, "lin", "type1", self._type1, res='int', dataOnly=True), 
-                              SLMap(0, 1, "lin", "sharp1", self._sharp1, res='float'), 
+                              SLMap(0, 1, "lin", "sharp1", self._sharp1, res='float', dataOnly=True), 
                               SLMap(0, 7, "lin", "type2", self._type2, res='int', dataOnly=True),
-                              SLMap(0, 1, "lin", "sharp2", self._sharp2, res='float'),
+                              SLMap(0, 1, "lin", "sharp2", self._sharp2, res='float', dataOnly=True),
                               SLMap(0, 7, "lin", "type3", self._type3, res='int', dataOnly=True),
-                              SLMap(0, 1, "lin", "sharp3", self._sharp3, res='float')]
+                              SLMap(0, 1, "lin", "sharp3", self._sharp3, res='float', dataOnly=True)]
         super().ctrl(self._map_list_osc, title, wxnoserver)
 
         self._map_list_filt = [SLMap(0, 1, "lin", "cutoffFact", self._cutoffFact, res='float'),
@@ -123,29 +259,117 @@ class mySubSynth(PyoObject):
         self._env.ctrl()
 
     def play(self, dur=0, delay=0):
-        self._osc1.play(dur, delay)
-        self._osc2.play(dur, delay)
-        self._osc3.play(dur, delay)
-        self._filt.play(dur, delay)
-        self._stereo.play(dur, delay)
+        for c in self._oscs:
+            c.play(dur, delay)
+        for c in self._children:
+            c.play(dur, delay)
         return super().play(dur, delay)
 
     def stop(self):
-        self._osc1.stop()
-        self._osc2.stop()
-        self._osc3.stop()
-        self._filt.stop()
-        self._stereo.stop()
+        for c in self._oscs:
+            c.stop()
+        for c in self._children:
+            c.stop()
         return super().stop()
 
     def out(self, chnl=0, inc=1, dur=0, delay=0):
-        self._osc1.play(dur, delay)
-        self._osc2.play(dur, delay)
-        self._osc3.play(dur, delay)
-        self._filt.play(dur, delay)
-        self._stereo.play(dur, delay)
+        for c in self._oscs:
+            c.play(dur, delay)
+        for c in self._children:
+            c.play(dur, delay)
         return super().out(chnl, inc, dur, delay)
 
+    def render_offline(self, server, seconds):
+        """
+        Render the synth without the realtime filter, running the ladder filter kernel instead.
+
+        The filtered notes are summed to mono and returned as a float32 numpy array,
+        at the level of one channel of the realtime output.
+        Raises ValueError if the server isn't an offline server waiting to be started,
+        or if the filter resonance is a PyoObject (as set by the ctrl() window).
+
+        The keyboard widget can't play an offline server, so notes must be queued on the
+        server before calling this method, e.g. server.addMidiEvent(144, 60, 100) for a
+        note on and server.addMidiEvent(144, 60, 0) for a note off, otherwise the result
+        is silent.
+
+        :Args:
+
+            server : Server
+                Server booted with audio="offline" and not started yet.
+            seconds : float
+                Duration of the rendering in seconds.
+
+        """
+        import numpy as np
+
+        # Server has no public getter for its audio backend
+        if server._audio != "offline":
+            raise ValueError("render_offline needs a Server created with audio=\"offline\".")
+        if server.getIsStarted():
+            raise ValueError("render_offline needs a Server that is not started yet.")
+        if isinstance(self._res, PyoObject):
+            raise ValueError("render_offline needs a float resonance, not a PyoObject. "
+                             "Set it with setRes(x) or the res attribute before rendering.")
+
+        sr = server.getSamplingRate()
+        size = int(seconds * sr)
+        voices = len(self._scaled)
+        inputs = [DataTable(size) for i in range(voices)]
+        cutoffs = [DataTable(size) for i in range(voices)]
+        recs = [TableRec(self._scaled[i], table=inputs[i]).play() for i in range(voices)]
+        recs += [TableRec(self._cutoffFreq[i], table=cutoffs[i]).play() for i in range(voices)]
+
+        # The realtime filter is not needed while the oscillators are recorded
+        playing = [(o, o.isPlaying()) for o in (self._filt, self._mono)]
+        self._filt.stop()
+        self._mono.stop()
+        fd, filename = tempfile.mkstemp(suffix=".wav")
+        os.close(fd)
+        try:
+            server.recordOptions(dur=seconds, filename=filename)
+            server.start()
+        finally:
+            os.remove(filename)
+            for o, p in playing:
+                if p:
+                    o.play()
+
+        out = np.zeros(size, dtype=np.float32)
+        voice = np.empty(size, dtype=np.float32)
+        for i in range(voices):
+            x = np.asarray(inputs[i].getTable(), dtype=np.float32)
+            f = np.asarray(cutoffs[i].getTable(), dtype=np.float32)
+            moog_ladder(x, np.zeros(8, dtype=np.float32), f, float(self._res), float(sr), voice)
+            out += voice
+        # Same -3 dB gain as the stereo output
+        out *= 0.707
+        return out
+
+    def _selectBand(self, voice):
+        """Point the wavetable oscillators of `voice` at the band matching its new pitch."""
+        band = _band(self._freqs.get(all=True)[voice], self._bandBase)
+        for tables, wave in zip(self._tables, self._waves):
+            wave.getBaseObjects()[voice].setTable(tables[band])
+
+    def _routeOsc(self, n, wavetype, sharp):
+        """Feed oscillator `n` from its wavetable, or from its LFO when the waveform can't be tabulated."""
+        if wavetype in _TABLE_TYPES and not isinstance(sharp, PyoObject):
+            for band, table in enumerate(self._tables[n]):
+                table.replace(_harmonics(wavetype, sharp, _MAX_ORDER >> band))
+                table.normalize()
+            active, idle = self._waves[n], self._lfos[n]
+        else:
+            self._lfos[n].type = wavetype
+            self._lfos[n].sharp = sharp
+            active, idle = self._lfos[n], self._waves[n]
+        if active is not self._oscs[n]:
+            if self._oscs[n].isPlaying():
+                active.play()
+            self._sources[n].setInput(active, fadetime=0.005)
+            self._oscs[n] = active
+        idle.stop()
+
     def setType1(self, x):
         """
         Replace the `type1` attribute.
@@ -157,7 +381,7 @@ class mySubSynth(PyoObject):
 
         """
         self._type1 = x
-        self._osc1.type = x
+        self._routeOsc(0, x, self._sharp1)
 
     def setSharp1(self, x):
         """
@@ -170,7 +394,7 @@ class mySubSynth(PyoObject):
 
         """
         self._sharp1 = x
-        self._osc1.sharp = x
+        self._routeOsc(0, self._type1, x)
 
     def setType2(self, x):
         """
@@ -183,7 +407,7 @@ class mySubSynth(PyoObject):
 
         """
         self._type2 = x
-        self._osc2.type = x
+        self._routeOsc(1, x, self._sharp2)
 
     def setSharp2(self, x):
         """
@@ -196,7 +420,7 @@ class mySubSynth(PyoObject):
 
         """
         self._sharp2 = x
-        self._osc2.sharp = x
+        self._routeOsc(1, self._type2, x)
 
     def setType3(self, x):
         """
@@ -209,7 +433,7 @@ class mySubSynth(PyoObject):
 
         """
         self._type3 = x
-        self._osc3.type = x
+        self._routeOsc(2, x, self._sharp3)
 
     def setSharp3(self, x):
         """
@@ -222,7 +446,7 @@ class mySubSynth(PyoObject):
 
         """
         self._sharp3 = x
-        self._osc3.sharp = x
+        self._routeOsc(2, self._type3, x)
 
     def setCutoffFact(self, x):
         """
@@ -235,7 +459,7 @@ class mySubSynth(PyoObject):
 
         """
         self._cutoffFact = x
-        self._filt.freq = self._env*20000*x
+        self._cutoffSig.value = x
     
     def setRes(self, x):
         """